@@ -12,12 +12,18 @@ Email report is sent to folks listed in user arguements --receiver-email and
 --cc-email.
 """
 
+import argparse
+import concurrent.futures
+import glob
 import os
 import string
-import sys
+import tempfile
 import time
 import smtplib
 
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from html import escape
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
@@ -26,6 +32,10 @@ CI_DIR = os.path.dirname(os.path.realpath(__file__))
 TEMPLATE_PATH = os.path.join(CI_DIR, "email_template.css")
 PICS_DIR = os.path.join(CI_DIR, "pics")
 
+# Process umask, read once at import while no other threads are running.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 # Header of elements to write to the summary file.
 TABLE_HEADER = ["Test ID",
                 "Result ID",
@@ -45,47 +55,92 @@ TABLE_STAT2 = [ "PASS",
                 "Total",
                 "% Passing"]
 
-def read_file(fname, delim=None):
+# Pre-built PASS/FAIL status cells.
+PASS_TD = ("<td style=\"background-color:ForestGreen; color:White; text-align:center;\">PASS</td>"
+           "<td class='left'></td>")
+FAIL_TD = "<td style=\"background-color:Red; color:White; text-align:center;\">Fail</td>"
+
+STATUS_TD = {"pass": PASS_TD,
+             "fail": FAIL_TD}
+
+# Header row keywords that switch create_table to a statistics table.
+_SECTION_TRANSITIONS = {"bucket": 1,
+                        "pass": 2}
+
+# Pre-built table headers.
+_STAT_THEAD = "<thead style=\"background-color:CornflowerBlue; font-size:1em\">"
+_HEADER_HTML = "<thead><tr><th>" + "</th><th>".join(TABLE_HEADER) + "</th></tr></thead>\n"
+_STAT1_HEADER_HTML = _STAT_THEAD + "<tr><th>" + "</th><th>".join(TABLE_STAT1) + "</th></tr></thead>\n"
+_STAT2_HEADER_HTML = _STAT_THEAD + "<tr><th>" + "</th><th>".join(TABLE_STAT2) + "</th></tr></thead>\n"
+
+# Pre-built table footers.
+_TABLE_CLOSE = "</tbody>\n<tfoot></tfoot>\n</table>\n"
+_TABLE_CLOSE_WITH_P = _TABLE_CLOSE + "<p> </p>\n"
+
+def read_file_raw(fname: str) -> str:
     """
-    Read file, output 2D list containing lines and words.
-    Words are defined by delimiter (Default: space (None)).
+    Read file, output its whole contents as a single string.
     """
     with open(fname, "r") as filehandler:
-        data = filehandler.readlines()
-    data = [x.rstrip() for x in data]
-    lines = [x.split(delim) for x in data]
-    return lines
-
-def collect_results(testsfile):
-    # Opening data file
-    ftext = open(testsfile)
-    test_list = []
-    i = 0
-    for line in ftext:
-        #print(len(line), ":", line)
-        i += 1
-        if (i <= 2) or (len(line.split()) < 4) or(line.split()[0][0] == '-'):
-            continue
-        line = line.replace("<", "&lt")
-        line = line.replace(">", "&gt")
-        test_list.append(line.split())
-
-    ftext.close()
+        return filehandler.read()
 
-    print("Total ", len(test_list), "  tests")
-    return test_list
+# CSS template for the email report, read and compiled on first use.
+_TEMPLATE_CACHE: Optional[Tuple[str, str]] = None
+_BODY_MARK = "\0body\0"
 
-def collect_head(headfile):
-    # Opening data file
-    ftext = open(headfile)
-    head_info = []
-    for line in ftext:
-        head_info.append(line.split())
-
-    ftext.close()
-    return head_info
+def _get_template() -> Tuple[str, str]:
+    """
+    Return the CSS template split into the parts before and after $body,
+    so the report body can be streamed between them.
+    """
+    global _TEMPLATE_CACHE
+    if _TEMPLATE_CACHE is None:
+        template = string.Template(read_file_raw(TEMPLATE_PATH))
+        parts = template.substitute(body=_BODY_MARK).split(_BODY_MARK)
+        if len(parts) != 2:
+            raise ValueError(f"{TEMPLATE_PATH} must contain exactly one $body "
+                             f"placeholder, found {len(parts) - 1}")
+        _TEMPLATE_CACHE = (parts[0], parts[1])
+    return _TEMPLATE_CACHE
+
+def _escape_and_split(line: str) -> Optional[List[str]]:
+    """
+    Split line on whitespace, output None if it is not a test report row.
+    Kept rows containing markup are HTML-escaped as a whole line and split
+    again (escaping never adds whitespace).
+    """
+    parts = line.split()
+    if (len(parts) < 4) or parts[0].startswith('-'):
+        return None
+    if "<" in line or ">" in line or "&" in line:
+        return escape(line, quote=False).split()
+    return parts
+
+def collect_results(testsfile: str) -> Iterator[List[str]]:
+    """
+    Yield the escaped, whitespace-split rows of a plain text test report.
+    """
+    count = 0
+    with open(testsfile) as ftext:
+        for i, line in enumerate(ftext, 1):
+            if i <= 2:
+                continue
+            parts = _escape_and_split(line)
+            if parts is None:
+                continue
+            count += 1
+            yield parts
+
+    print(f"Total  {count}   tests in {testsfile}\n", end="", flush=True)
+
+def collect_head(headfile: str) -> List[str]:
+    """
+    Read head file, output a list of its lines.
+    """
+    with open(headfile) as ftext:
+        return ftext.read().splitlines()
 
-def create_head(head_info):
+def create_head(head_info: List[str]) -> str:
     """
     Create html results table.
     """
@@ -93,103 +148,92 @@ def create_head(head_info):
     # Create test result table.
     head = []
     head.append("<p>\n")
-    head.append(f"<b>Regression test path: </b>{head_info[0][0]}<br>\n")
-    head.append(f"<b>Latest commit on test branch: </b>{head_info[1][0]}<br>\n")
+    head.append(f"<b>Regression test path: </b>{head_info[0]}<br>\n")
+    head.append(f"<b>Latest commit on test branch: </b>{head_info[1]}<br>\n")
     head.append("</p>\n")
 
     html_head = "".join(head)
     return html_head
 
-def create_table(test_list):
+def create_table(out: TextIO, test_list: Iterable[List[str]]) -> Dict[str, int]:
     """
-    Create html results table.
+    Create html results table and write it to out.
+    test_list may be any iterable of split report rows.
+    Returns a dict of pass/fail/total test counts, plus the "No Status"
+    count as missing when the report has a summary row.
     """
 
     # Create test result table.
-    test_table = []
-    test_table.append("<table>")
-    table_header = [x for x in TABLE_HEADER]
-    test_table.append("<thead><tr><th>" +
-                     "</th><th>".join(table_header) +
-                     "</th></tr></thead>\n")
-
-    stat1_table = []
-    stat1_table.append("<table>")
-    table_header = [x for x in TABLE_STAT1]
-    stat1_table.append("<thead style=\"background-color:CornflowerBlue; font-size:1em\"><tr><th>" +
-                     "</th><th>".join(table_header) +
-                     "</th></tr></thead>\n")    
-    stat2_table = []
-    stat2_table.append("<table>")
-    # Append table header.
-    table_header = [x for x in TABLE_STAT2]
-    stat2_table.append("<thead style=\"background-color:CornflowerBlue; font-size:1em\"><tr><th>" +
-                     "</th><th>".join(table_header) +
-                     "</th></tr></thead>\n")
+    test_table = ["<table>", _HEADER_HTML]
+    stat1_table = ["<table>", _STAT1_HEADER_HTML]
+    stat2_table = ["<table>", _STAT2_HEADER_HTML]
+
+    # Bind hot-loop lookups to locals once instead of per row/cell.
+    test_append = test_table.append
+    stat1_append = stat1_table.append
+    stat2_append = stat2_table.append
+    status_td = STATUS_TD.get
+    bucket_col = len(TABLE_STAT1) - 1
+
+    # Count test statuses while writing the rows.
+    stats = {"pass": 0, "fail": 0, "total": 0}
 
     # Append table body.
-    stat1 = False
-    stat2 = False
+    # state: 0 = test results, 1 = bucket statistics, 2 = pass/fail summary.
+    state = 0
     for test in test_list:
-        if (test[0].lower() == "bucket"):           # Append statistics
-            stat1 = True
-        elif (test[0].lower() == "pass"):           # Append statistics
-            stat2 = True
-            stat1 = False
+        section = _SECTION_TRANSITIONS.get(test[0].lower())
+        if section is not None:             # Statistics header row
+            state = section
+        elif state == 0:
+            status = None
+            test_append("<tr>")
+            for item in test:
+                # Only four-letter words can be PASS/FAIL; skip lower() otherwise.
+                if len(item) == 4:
+                    il = item.lower()
+                    td = status_td(il)
+                    if td is not None:
+                        if status is None:      # Count one status per test
+                            status = il
+                        test_append(td)
+                        continue
+                test_append(f"<td class='left'>{item}</td>")
+            test_append("</tr>\n")
+            if status is not None:
+                stats[status] += 1
+            stats["total"] += 1
+        elif state == 1:
+            bucketName = " ".join(test[bucket_col:])
+            stat1_append(f"<tr><td class='center'>{test[0]}</td>"
+                         f"<td class='center'>{test[1]}</td>"
+                         f"<td class='center'>{bucketName}</td></tr>\n")
         else:
-            if( stat1 ):
-                stat1_table.append("<tr>")
-                bucketName = " ".join(test[len(TABLE_STAT1)-1:])
-                stat1_table.append(f"<td class='center'>{test[0]}</td>")
-                stat1_table.append(f"<td class='center'>{test[1]}</td>")
-                stat1_table.append(f"<td class='center'>{bucketName}</td>")
-                stat1_table.append("</tr>\n")
-            elif( stat2 ):
-                stat2_table.append("<tr>")
-                for item in test:
-                    stat2_table.append(f"<td class='center'>{item}</td>")  
-                stat2_table.append("</tr>\n") 
-                stat2 = False            
-            else:
-                test_table.append("<tr>")
-                for item in test:
-                    if (item.lower() == "pass"):
-                        test_table.append(f"<td style=\"background-color:ForestGreen; color:White; text-align:center;\">PASS</td>")
-                        test_table.append("<td class='left'>"  "</td>")
-                    elif (item.lower() == "fail"):
-                        test_table.append(f"<td style=\"background-color:Red; color:White; text-align:center;\">Fail</td>")
-                    else:             
-                        test_table.append(f"<td class='left'>{item}</td>")
-                test_table.append("</tr>\n")
-
-    test_table.append("</tbody>\n")
-    # Append table footer.
-    test_table.append("<tfoot></tfoot>\n")
-    # Complete table.
-    test_table.append("</table>\n")
-
-    stat1_table.append("</tbody>\n")
-    # Append table footer.
-    stat1_table.append("<tfoot></tfoot>\n")
-    # Complete table.
-    stat1_table.append("</table>\n")
-    stat1_table.append("<p> </p>\n") 
-
-    stat2_table.append("</tbody>\n")
-    # Append table footer.
-    stat2_table.append("<tfoot></tfoot>\n")
-    # Complete table.
-    stat2_table.append("</table>\n")    
-    stat2_table.append("<p> </p>\n") 
-
-    tables = stat1_table + stat2_table + test_table
-    html_tables = "".join(tables)
-    return html_tables
-
-
-def create_message(test_list, head_info):
+            cells = "".join([f"<td class='center'>{item}</td>" for item in test])
+            stat2_append(f"<tr>{cells}</tr>\n")
+            if len(test) > 2 and test[2].isdigit():
+                stats["missing"] = int(test[2])
+            state = 0
+
+    # Complete tables with footers.
+    test_append(_TABLE_CLOSE)
+    stat1_append(_TABLE_CLOSE_WITH_P)
+    stat2_append(_TABLE_CLOSE_WITH_P)
+
+    # Write each table to out in order, without joining them into one string.
+    for table in (stat1_table, stat2_table, test_table):
+        out.write("".join(table))
+
+    return stats
+
+
+def write_message(out: TextIO,
+                  test_list: Iterable[List[str]],
+                  head_info: List[str]) -> Dict[str, int]:
     """
-    Create HTML email report using optional args vars and test results.
+    Write HTML email report using optional args vars and test results to
+    the writable out (an open file or io.StringIO).
+    Returns the test counts collected by create_table.
     """
 
     # TODO - add timestamp user arg later to overwrite (would rather want
@@ -198,29 +242,23 @@ def create_message(test_list, head_info):
     timestamp = time.strftime("%Y%m%dT%H%M")
     title = f"UVM Regression Tests {timestamp}"
 
-    # Create html message body.
-
-    # Create html title
-    html_title = f"<h1>{title}</h1>"
-
-    # Create html head
-    html_head = create_head(head_info)
-    # Create html tables.
-    html_tables = create_table(test_list)
-
-    # Import and process CSS template file for email report.
-    template = read_file(TEMPLATE_PATH, delim="\n")
-    template = ["".join(line) for line in template]
-    template = "\n".join(template)
-    template = string.Template(template)
-
-    # Assemble complete message.
-    html_report = html_title + html_head + html_tables
-    html_report = template.substitute(body=html_report)
-
-    return html_report
-
-def create_email(to_file, cc_file, html_report):
+    # Write html message body into the CSS template.
+    template_head, template_tail = _get_template()
+    out.write(template_head)
+    # Write html title
+    out.write(f"<h1>{title}</h1>")
+    # Write html head
+    out.write(create_head(head_info))
+    # Write html tables.
+    stats = create_table(out, test_list)
+    out.write(template_tail)
+
+    return stats
+
+def create_email(to_file: str,
+                 cc_file: str,
+                 html_report: str,
+                 stats: Dict[str, int]) -> None:
     """
     Send email report.
     """
@@ -234,54 +272,132 @@ def create_email(to_file, cc_file, html_report):
     message_subject = "Regression results for OFS FIM UVM simulation --- test from Ling"
     message["Subject"] = message_subject
     message["From"] = sender_email
-    file = open(to_file, "r")
-    message["To"] = file.read()
-    file.close()
-    file = open(cc_file, "r")
-    message["CC"] = file.read()
-    file.close()
+    message["To"] = read_file_raw(to_file).strip()
+    message["CC"] = read_file_raw(cc_file).strip()
     message["X-Regtest-Title"] = message_subject
-    message["X-Regtest-Failed"] = ""
-    message["X-Regtest-Passed"] = ""
+    message["X-Regtest-Failed"] = str(stats["fail"])
+    message["X-Regtest-Passed"] = str(stats["pass"])
     message["X-Regtest-Timeout"] = ""
-    message["X-Regtest-Missing"] = ""
-    message["X-Regtest-Total"] = ""
+    message["X-Regtest-Missing"] = str(stats["missing"]) if "missing" in stats else ""
+    message["X-Regtest-Total"] = str(stats["total"])
 
-    html_report = MIMEText(html_report, "html")
-    message.attach(html_report)
+    html_part = MIMEText(html_report, "html")
+    message.attach(html_part)
 
     #with smtplib.SMTP(mail_host) as smtp:
      #   smtp.send_message(message)
 
-def main(to_email,
-         cc_email,
-         report_name,
-         head_name
-         ):
+def generate_one(to_email: str,
+                 cc_email: str,
+                 report_name: str,
+                 head_name: str
+                 ) -> None:
     """
-    Collect test results from parallel test sim runs.
-    Send email report with results.
+    Collect test results from one plain text report.
+    Write the HTML report next to it and send email report with results.
     """
-    print("to: ", to_email, "\ncc: ", cc_email, "\nplain text report: ", report_name, "\nhead:", head_name )
+    # One write per message (newline included), so output from parallel
+    # workers does not interleave.
+    print(f"to:  {to_email} \ncc:  {cc_email} \nplain text report:  {report_name} \nhead: {head_name}\n",
+          end="", flush=True)
 
     test_list = collect_results(report_name)
     head_info = collect_head(head_name)
-    html_report = create_message(test_list, head_info)
-    create_email(to_email, cc_email, html_report)
     base = os.path.splitext(report_name)[0]
     html_file = base + ".html"
-    fhtml = open(html_file, 'w')
-    fhtml.write(html_report)
-    fhtml.close()
 
-if __name__ == '__main__':
-    if( len(sys.argv) < 5 ):
-        print("Usage: generate_html.py to_email_list_file cc_email_list_file plain_text_test_report head_file_name")
-        exit(-1)
+    # Stream the report into a temporary file and only replace html_file
+    # once it is complete, so a bad input (or an input that is itself
+    # html_file) never truncates it.
+    # mkstemp gives every worker its own name; it creates the file 0600, so
+    # restore the permissions open() would have used.
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(html_file)),
+                                    suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as fhtml:
+            stats = write_message(fhtml, test_list, head_info)
+        os.chmod(tmp_name, 0o666 & ~_UMASK)
+        os.replace(tmp_name, html_file)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+    create_email(to_email, cc_email, read_file_raw(html_file), stats)
+
+def main(to_email: str,
+         cc_email: str,
+         report_name: str,
+         head_name: str,
+         jobs: Optional[int] = None,
+         pattern: str = "*.txt"
+         ) -> None:
+    """
+    Collect test results from parallel test sim runs.
+    Send email report with results.
+    If report_name is a directory, every report in it matching pattern is
+    generated concurrently using up to jobs processes (Default: CPU count).
+    The email list and head files and existing .html reports are never
+    treated as reports, and only the first report per .html name is used.
+    """
+    if not os.path.isdir(report_name):
+        generate_one(to_email, cc_email, report_name, head_name)
+        return
+
+    inputs = [f for f in (to_email, cc_email, head_name) if os.path.exists(f)]
+    html_files = set()
+    reports = []
+    for report in sorted(glob.glob(os.path.join(report_name, pattern))):
+        if (not os.path.isfile(report) or report.endswith(".html")
+                or any(os.path.samefile(report, f) for f in inputs)):
+            continue
+        html_file = os.path.splitext(report)[0] + ".html"
+        if html_file in html_files:
+            print("Skipping", report, ":", html_file, "is already generated from another report")
+            continue
+        html_files.add(html_file)
+        reports.append(report)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count() if jobs is None else jobs) as executor:
+        futures = [executor.submit(generate_one, to_email, cc_email, report, head_name)
+                   for report in reports]
+        for future in futures:
+            future.result()
+
+def _positive_int(value: str) -> int:
+    """
+    argparse type for options that must be an integer of at least 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"must be an integer, got {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+def cli(argv: Optional[List[str]] = None) -> None:
+    """
+    Parse command line arguments (Default: sys.argv) and run main.
+    """
+    parser = argparse.ArgumentParser(description="Generate HTML email reports from plain text test reports.")
+    parser.add_argument("to_email_list_file")
+    parser.add_argument("cc_email_list_file")
+    parser.add_argument("plain_text_test_report",
+                        help="report file, or a directory of report files")
+    parser.add_argument("head_file_name")
+    parser.add_argument("--jobs", type=_positive_int, default=None,
+                        help="reports generated in parallel for a directory (Default: CPU count)")
+    parser.add_argument("--pattern", default="*.txt",
+                        help="report file name pattern for a directory (Default: *.txt)")
+    args = parser.parse_args(argv)
 
     main(
-        sys.argv[1],
-        sys.argv[2],
-        sys.argv[3],
-        sys.argv[4]
+        args.to_email_list_file,
+        args.cc_email_list_file,
+        args.plain_text_test_report,
+        args.head_file_name,
+        args.jobs,
+        args.pattern
     )
+
+if __name__ == '__main__':
+    cli()
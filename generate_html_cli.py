@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+"""
+Command line launcher for generate_html.
+
+Runs the same command line as generate_html.py, but imports the module, so
+a mypyc-compiled generate_html extension is used when one is present.
+"""
+
+from generate_html import cli
+
+if __name__ == '__main__':
+    cli()